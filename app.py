@@ -3,13 +3,19 @@ Lab Report Decoder - Flask Application
 Professional web interface for lab report analysis
 """
 
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, render_template, request, jsonify, session, stream_with_context
+from flask_session import Session
+from cachelib.file import FileSystemCache
 from werkzeug.utils import secure_filename
 import os
+import json
 import tempfile
 import secrets
-from pdf_extractor import LabReportExtractor
+import threading
+from datetime import timedelta
+from pdf_extractor import LabReportExtractor, LabResult
 from rag_engine import LabReportRAG
+from build_vector_db import build_knowledge_base
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,16 +27,33 @@ app.secret_key = os.getenv('SECRET_KEY', secrets.token_hex(16))
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
 
+# Keep extracted results server-side; the cookie only carries the session id
+app.config['SESSION_TYPE'] = 'cachelib'
+# Results are health data: expire them from disk after an hour
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=1)
+app.config['SESSION_CACHELIB'] = FileSystemCache(
+    cache_dir=os.path.join(tempfile.gettempdir(), 'lab_decoder_sessions'),
+    threshold=500
+)
+Session(app)
+
 # Initialize RAG system (singleton)
 rag_system = None
+# A background preload and request threads may race to create it
+rag_system_lock = threading.Lock()
 
 def get_rag_system():
-    """Lazy load RAG system"""
+    """Lazy load RAG system (preloaded at startup, see gunicorn.conf.py)"""
     global rag_system
-    if rag_system is None:
-        rag_system = LabReportRAG()
+    with rag_system_lock:
+        if rag_system is None:
+            rag_system = LabReportRAG()
     return rag_system
 
+def _rehydrate(results_data):
+    """Rebuild LabResult objects from session data"""
+    return [LabResult(**r) for r in results_data]
+
 @app.route('/')
 def index():
     """Main page"""
@@ -103,26 +126,21 @@ def explain_results():
             return jsonify({'error': 'No results found. Please upload a PDF first.'}), 400
         
         # Convert back to LabResult objects
-        from pdf_extractor import LabResult
-        results = [
-            LabResult(
-                test_name=r['test_name'],
-                value=r['value'],
-                unit=r['unit'],
-                reference_range=r['reference_range'],
-                status=r['status']
-            )
-            for r in results_data
-        ]
-        
-        # Generate explanations
+        results = _rehydrate(results_data)
+        
+        # Stream explanations as server-sent events while they are generated
         rag = get_rag_system()
-        explanations = rag.explain_all_results(results)
         
-        return jsonify({
-            'success': True,
-            'explanations': explanations
-        })
+        def generate():
+            for index, text, failed in rag.stream_explanations(results):
+                event = {
+                    'index': index,
+                    'test_name': results[index].test_name,
+                    'error' if failed else 'text': text
+                }
+                yield f"data: {json.dumps(event)}\n\n"
+        
+        return Response(stream_with_context(generate()), mimetype='text/event-stream')
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -143,17 +161,7 @@ def ask_question():
             return jsonify({'error': 'No results found. Please upload a PDF first.'}), 400
         
         # Convert back to LabResult objects
-        from pdf_extractor import LabResult
-        results = [
-            LabResult(
-                test_name=r['test_name'],
-                value=r['value'],
-                unit=r['unit'],
-                reference_range=r['reference_range'],
-                status=r['status']
-            )
-            for r in results_data
-        ]
+        results = _rehydrate(results_data)
         
         # Get answer
         rag = get_rag_system()
@@ -178,29 +186,20 @@ def get_summary():
             return jsonify({'error': 'No results found. Please upload a PDF first.'}), 400
         
         # Convert back to LabResult objects
-        from pdf_extractor import LabResult
-        results = [
-            LabResult(
-                test_name=r['test_name'],
-                value=r['value'],
-                unit=r['unit'],
-                reference_range=r['reference_range'],
-                status=r['status']
-            )
-            for r in results_data
-        ]
+        results = _rehydrate(results_data)
         
         # Generate summary
         rag = get_rag_system()
         summary = rag.generate_summary(results)
         
-        # Calculate statistics
+        # Calculate statistics from the stored dicts
+        statuses = [r['status'] for r in results_data]
         stats = {
-            'total': len(results),
-            'normal': sum(1 for r in results if r.status == 'normal'),
-            'high': sum(1 for r in results if r.status == 'high'),
-            'low': sum(1 for r in results if r.status == 'low'),
-            'unknown': sum(1 for r in results if r.status == 'unknown')
+            'total': len(statuses),
+            'normal': statuses.count('normal'),
+            'high': statuses.count('high'),
+            'low': statuses.count('low'),
+            'unknown': statuses.count('unknown')
         }
         
         return jsonify({
@@ -227,8 +226,12 @@ def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
+    # Build in-process so the embedding model and Chroma client loaded for
+    # the build are reused by the RAG system below
     if not(os.path.isdir('chroma_db/')):
-         os.system("python build_vector_db.py")
+        build_knowledge_base()
+    # Load models before serving so the first request doesn't pay for it
+    get_rag_system()
     #any available port
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
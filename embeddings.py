@@ -0,0 +1,27 @@
+"""
+Shared model and vector store handles for Lab Report Decoder
+Loaded once per process and reused by the build script and the RAG engine
+"""
+
+import functools
+from sentence_transformers import SentenceTransformer
+import chromadb
+import torch
+
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+@functools.lru_cache(maxsize=1)
+def get_embedder() -> SentenceTransformer:
+    """Return the process-wide sentence embedding model"""
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    
+    # Half precision roughly doubles GPU encode throughput
+    if torch.cuda.is_available():
+        model = model.half()
+    
+    return model
+
+@functools.lru_cache(maxsize=None)
+def get_chroma_client(db_path: str = "./chroma_db") -> chromadb.ClientAPI:
+    """Return the process-wide ChromaDB client for a database path"""
+    return chromadb.PersistentClient(path=db_path)
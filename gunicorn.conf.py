@@ -0,0 +1,35 @@
+"""
+Gunicorn settings for Lab Report Decoder
+Loads the models before serving: in the master on CPU hosts (shared with
+workers copy-on-write), in each worker on CUDA hosts
+"""
+
+import os
+import threading
+
+# Check for CUDA through NVML so the master never initialises the CUDA
+# runtime; forked workers can't re-initialise it
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+import torch
+
+# Import the app in the master so workers share its memory copy-on-write
+preload_app = True
+
+def when_ready(server):
+    """On CPU hosts, load the RAG models before the first worker is forked"""
+    if not torch.cuda.is_available():
+        from app import get_rag_system
+        get_rag_system()
+
+def post_fork(server, worker):
+    """Split CPU threads between workers and, on CUDA hosts, load the models"""
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // server.cfg.workers))
+    
+    # CUDA state can't cross a fork, so each worker loads its own copy. The
+    # load runs in a background thread so the worker keeps heartbeating to
+    # the master (a first start may download the full Phi-3 weights, well
+    # past --timeout); requests arriving meanwhile wait in get_rag_system()
+    if torch.cuda.is_available():
+        from app import get_rag_system
+        threading.Thread(target=get_rag_system, daemon=True).start()
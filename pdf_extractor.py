@@ -5,10 +5,52 @@ Extracts lab test names, values, and ranges from uploaded PDF files
 
 import pdfplumber
 import re
+import os
+import mmap
+import multiprocessing
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, List, Optional
 from dataclasses import dataclass
 
-@dataclass
+# Reports shorter than this are extracted serially: starting work in another
+# process (re-importing modules, re-parsing the PDF) costs more than a page
+PARALLEL_PAGE_THRESHOLD = 16
+
+# Worker processes for large reports: the CPUs this process may actually run
+# on, capped so a spawned pool stays small next to the loaded models
+if hasattr(os, "sched_getaffinity"):
+    PAGE_WORKERS = min(4, len(os.sched_getaffinity(0)))
+else:
+    PAGE_WORKERS = min(4, os.cpu_count() or 1)
+
+# Long-lived worker pool for large reports, created on first use
+_page_pool = None
+_page_pool_lock = threading.Lock()
+
+def _get_page_pool() -> ProcessPoolExecutor:
+    """Return the shared page extraction pool, starting it if needed"""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            # Spawned rather than forked so workers don't inherit the web
+            # server's threads and loaded models
+            _page_pool = ProcessPoolExecutor(
+                max_workers=PAGE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _page_pool
+
+@contextmanager
+def _open_pdf(pdf_path: str):
+    """Open a PDF through a read-only memory map so pages are read on demand"""
+    with open(pdf_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            pdfplumber.open(mm) as pdf:
+        yield pdf
+
+@dataclass(slots=True, frozen=True)
 class LabResult:
     """Represents a single lab test result"""
     test_name: str
@@ -20,6 +62,9 @@ class LabResult:
 class LabReportExtractor:
     """Extract structured data from lab report PDFs"""
     
+    # Reference range such as "12.0-15.5"
+    _RANGE_RE = re.compile(r'([\d.]+)\s*-\s*([\d.]+)')
+    
     def __init__(self):
         # Common lab test patterns
         self.test_patterns = [
@@ -29,28 +74,62 @@ class LabReportExtractor:
             r'(Iron|Ferritin)\s*:?\s*([\d.]+)\s*([a-zA-Z/]+)?\s*(?:Ref\.?\s*Range:?\s*)?([\d.\-\s]+)',
             r'(Cholesterol|LDL|HDL)\s*:?\s*([\d.]+)\s*([a-zA-Z/]+)?\s*(?:Ref\.?\s*Range:?\s*)?([\d.\-\s]+)',
         ]
+        
+        # Compiled once per extractor. Each pattern still scans the text on its
+        # own: matches from different patterns may overlap (e.g. a unitless
+        # value whose unit group would swallow the next test's name)
+        self._compiled_patterns = [re.compile(p, re.IGNORECASE) for p in self.test_patterns]
     
     def extract_from_pdf(self, pdf_path: str) -> List[LabResult]:
         """Extract lab results from PDF file"""
         results = []
         
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text()
-                
-                # Try to extract tables first (more structured)
-                tables = page.extract_tables()
-                if tables:
-                    results.extend(self._parse_tables(tables))
-                
-                # Fall back to pattern matching
-                results.extend(self._parse_text(text))
+        with _open_pdf(pdf_path) as pdf:
+            page_count = len(pdf.pages)
+            parallel = page_count >= PARALLEL_PAGE_THRESHOLD and PAGE_WORKERS > 1
+            
+            if not parallel:
+                for page in pdf.pages:
+                    results.extend(self._extract_page(page))
+        
+        if parallel:
+            # Layout analysis is CPU-bound and independent per page. Each worker
+            # gets one contiguous range of pages so it opens the PDF only once.
+            workers = PAGE_WORKERS
+            page_ranges = [
+                list(range(i * page_count // workers, (i + 1) * page_count // workers))
+                for i in range(workers)
+            ]
+            for range_results in _get_page_pool().map(
+                _extract_pages_from_file, [pdf_path] * workers, page_ranges
+            ):
+                results.extend(range_results)
         
         # Remove duplicates
         unique_results = self._deduplicate_results(results)
         
         return unique_results
     
+    def _extract_page(self, page) -> List[LabResult]:
+        """Extract lab results from a single pdfplumber page"""
+        results = []
+        
+        # Scanned pages have no text layer; skip the costly table detection
+        if not page.chars:
+            return results
+        
+        text = page.extract_text()
+        
+        # Try to extract tables first (more structured)
+        tables = page.extract_tables()
+        if tables:
+            results.extend(self._parse_tables(tables))
+        
+        # Fall back to pattern matching
+        results.extend(self._parse_text(text))
+        
+        return results
+    
     def _parse_tables(self, tables: List) -> List[LabResult]:
         """Parse lab results from extracted tables"""
         results = []
@@ -94,24 +173,18 @@ class LabReportExtractor:
         """Parse lab results using regex patterns"""
         results = []
         
-        for pattern in self.test_patterns:
-            matches = re.finditer(pattern, text, re.IGNORECASE)
-            for match in matches:
-                groups = match.groups()
-                if len(groups) >= 2:
-                    test_name = groups[0]
-                    value = groups[1]
-                    unit = groups[2] if len(groups) > 2 else ''
-                    ref_range = groups[3] if len(groups) > 3 else ''
-                    
-                    status = self._determine_status(value, ref_range)
-                    results.append(LabResult(
-                        test_name=test_name,
-                        value=value,
-                        unit=unit or '',
-                        reference_range=ref_range or '',
-                        status=status
-                    ))
+        for pattern in self._compiled_patterns:
+            for match in pattern.finditer(text):
+                test_name, value, unit, ref_range = match.groups()
+                
+                status = self._determine_status(value, ref_range)
+                results.append(LabResult(
+                    test_name=test_name,
+                    value=value,
+                    unit=unit or '',
+                    reference_range=ref_range or '',
+                    status=status
+                ))
         
         return results
     
@@ -125,38 +198,47 @@ class LabReportExtractor:
     
     def _determine_status(self, value: str, ref_range: str) -> str:
         """Determine if value is normal, high, or low"""
+        # Without a parseable reference range there's nothing to compare against
+        range_match = self._RANGE_RE.search(ref_range) if ref_range else None
+        if not range_match:
+            return 'unknown'
+        
         try:
             val = float(value.replace(',', ''))
-            
-            # Parse reference range
-            range_match = re.search(r'([\d.]+)\s*-\s*([\d.]+)', ref_range)
-            if range_match:
-                low = float(range_match.group(1))
-                high = float(range_match.group(2))
-                
-                if val < low:
-                    return 'low'
-                elif val > high:
-                    return 'high'
-                else:
-                    return 'normal'
+            low = float(range_match.group(1))
+            high = float(range_match.group(2))
         except (ValueError, AttributeError):
-            pass
+            return 'unknown'
         
-        return 'unknown'
+        if val < low:
+            return 'low'
+        elif val > high:
+            return 'high'
+        else:
+            return 'normal'
     
     def _deduplicate_results(self, results: List[LabResult]) -> List[LabResult]:
         """Remove duplicate test results"""
-        seen = set()
-        unique = []
+        # Dicts keep insertion order, so the first occurrence of each key wins
+        unique = {}
         
         for result in results:
-            key = (result.test_name.lower(), result.value)
-            if key not in seen:
-                seen.add(key)
-                unique.append(result)
+            unique.setdefault((result.test_name.lower(), result.value), result)
         
-        return unique
+        return list(unique.values())
+
+def _extract_pages_from_file(pdf_path: str, page_numbers: List[int]) -> List[LabResult]:
+    """Extract lab results from some pages of a PDF (runs in a worker process)"""
+    results = []
+    if not page_numbers:
+        return results
+    
+    extractor = LabReportExtractor()
+    with _open_pdf(pdf_path) as pdf:
+        for page_num in page_numbers:
+            results.extend(extractor._extract_page(pdf.pages[page_num]))
+    
+    return results
 
 # Example usage
 if __name__ == "__main__":
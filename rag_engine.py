@@ -3,24 +3,61 @@ RAG Query Engine for Lab Report Decoder
 Uses Hugging Face models for embeddings and generation
 """
 
-from sentence_transformers import SentenceTransformer
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
-import chromadb
+from transformers import (
+    pipeline, AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, BitsAndBytesConfig,
+    StoppingCriteria, StoppingCriteriaList
+)
 from chromadb.config import Settings
-from typing import List, Dict
+from typing import List, Dict, Optional, Iterator, Tuple
+from collections import OrderedDict
+import threading
+import copy
+import importlib.util
+from contextlib import closing
 from pdf_extractor import LabResult
+from embeddings import get_embedder, get_chroma_client
 import torch
 
+# Per-result explanations are short; longer answers keep the 512 default
+EXPLANATION_MAX_TOKENS = 200
+GENERATION_ERROR = "Sorry, I encountered an error generating the explanation."
+
+# Shared opening of every explanation prompt; its KV cache is computed once
+EXPLANATION_PREFIX = """You are a helpful medical assistant. Explain this lab result in simple terms.
+
+Medical Information:
+"""
+
+class _StopOnEvent(StoppingCriteria):
+    """Stop generation once an event is set, e.g. when the client goes away"""
+    
+    def __init__(self, event: threading.Event):
+        self.event = event
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
 class LabReportRAG:
     """RAG system for explaining lab results using Hugging Face models"""
     
-    def __init__(self, db_path: str = "./chroma_db"):
+    def __init__(self, db_path: str = "./chroma_db", cache_size: int = 512):
         """Initialize the RAG system with Hugging Face models"""
         
+        # Generated responses keyed by prompt, oldest evicted first
+        self._response_cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        
+        # Token ids and attention KV cache for EXPLANATION_PREFIX, built on first use
+        self._prefix_ids = None
+        self._prefix_kv = None
+        
         print("🔄 Loading Hugging Face models...")
         
         # Use smaller, faster models for embeddings
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.embedding_model = get_embedder()
         
         # Use a medical-focused or general LLM
         # Options: 
@@ -32,12 +69,26 @@ class LabReportRAG:
         
         try:
             self.tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+            
+            # Load int8 weights on GPU when bitsandbytes is installed
+            quantization_config = None
+            if torch.cuda.is_available() and importlib.util.find_spec("bitsandbytes") is not None:
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            
             self.llm = AutoModelForCausalLM.from_pretrained(
                 model_name,
                 trust_remote_code=True,
                 torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                device_map="auto" if torch.cuda.is_available() else None
+                device_map="auto" if torch.cuda.is_available() else None,
+                quantization_config=quantization_config
             )
+            
+            # On CPU, quantize linear layers to int8 (fbgemm uses VNNI where available)
+            if not torch.cuda.is_available():
+                # inplace avoids a deep copy, i.e. two FP32 models in memory
+                self.llm = torch.ao.quantization.quantize_dynamic(
+                    self.llm, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+                )
             print(f"✅ Loaded model: {model_name}")
         except Exception as e:
             print(f"⚠️ Could not load {model_name}, falling back to simpler model")
@@ -51,86 +102,224 @@ class LabReportRAG:
         
         # Load vector store
         try:
-            self.client = chromadb.PersistentClient(path=db_path)
+            self.client = get_chroma_client(db_path)
             self.collection = self.client.get_collection("lab_reports")
             print("✅ Vector database loaded")
         except Exception as e:
             print(f"⚠️ No vector database found. Please run build_vector_db.py first.")
             self.collection = None
     
-    def _generate_with_phi(self, prompt: str, max_tokens: int = 512) -> str:
-        """Generate text using Phi-3 model"""
+    def _explanation_prefix_state(self):
+        """Run the shared explanation prefix through Phi-3 once and keep its KV cache"""
+        if self._prefix_kv is None:
+            prefix_ids = self.tokenizer(EXPLANATION_PREFIX, return_tensors="pt").input_ids
+            
+            if torch.cuda.is_available():
+                prefix_ids = prefix_ids.to('cuda')
+            
+            with torch.no_grad():
+                outputs = self.llm(prefix_ids, use_cache=True)
+            
+            self._prefix_ids = prefix_ids
+            self._prefix_kv = outputs.past_key_values
+        
+        return self._prefix_ids, self._prefix_kv
+    
+    def _phi_inputs(self, prompt: str) -> dict:
+        """Tokenize a prompt for Phi-3 on the model's device"""
+        if prompt.startswith(EXPLANATION_PREFIX):
+            # Only the part after the shared prefix needs a prefill pass; the
+            # prefix tokens are reused together with their cached attention state
+            prefix_ids, prefix_kv = self._explanation_prefix_state()
+            suffix_ids = self.tokenizer(
+                prompt[len(EXPLANATION_PREFIX):],
+                return_tensors="pt",
+                add_special_tokens=False,
+                truncation=True,
+                max_length=2048 - prefix_ids.shape[1]
+            ).input_ids
+            
+            if torch.cuda.is_available():
+                suffix_ids = suffix_ids.to('cuda')
+            
+            input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+            return {
+                'input_ids': input_ids,
+                'attention_mask': torch.ones_like(input_ids),
+                # generate() extends the cache in place, so each call gets a copy
+                'past_key_values': copy.deepcopy(prefix_kv)
+            }
+        
         inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048)
         
         if torch.cuda.is_available():
             inputs = {k: v.to('cuda') for k, v in inputs.items()}
         
+        return inputs
+    
+    def _generate_with_phi(self, prompt: str, max_tokens: int = 512) -> str:
+        """Generate text using Phi-3 model"""
+        inputs = self._phi_inputs(prompt)
+        
+        # Greedy decoding: deterministic and cheaper than sampling
         outputs = self.llm.generate(
             **inputs,
             max_new_tokens=max_tokens,
-            temperature=0.7,
-            do_sample=True,
-            top_p=0.9
+            do_sample=False,
+            num_beams=1
         )
         
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        # Remove the prompt from response
-        response = response.replace(prompt, "").strip()
-        return response
+        # Decode only the new tokens; the prompt may be tokenized in two parts,
+        # so its decoded text isn't guaranteed to match the original string
+        new_tokens = outputs[0][inputs['input_ids'].shape[1]:]
+        response = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+        return response.strip()
+    
+    def _stream_with_phi(self, prompt: str, max_tokens: int = 512) -> Iterator[str]:
+        """Yield Phi-3 output text as it is generated"""
+        inputs = self._phi_inputs(prompt)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop_event = threading.Event()
+        errors = []
+        
+        def run():
+            try:
+                self.llm.generate(
+                    **inputs,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop_event)]),
+                    max_new_tokens=max_tokens,
+                    do_sample=False,
+                    num_beams=1
+                )
+            except Exception as e:
+                errors.append(e)
+                # Unblock the consumer loop below
+                streamer.end()
+        
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                yield text
+        finally:
+            # If the consumer stopped early (client disconnected), end the
+            # background generate() instead of decoding to max_new_tokens
+            stop_event.set()
+        thread.join()
+        
+        if errors:
+            raise errors[0]
     
     def _generate_with_fallback(self, prompt: str) -> str:
         """Generate text using fallback pipeline"""
         result = self.text_generator(prompt, max_length=512, num_return_sequences=1)
         return result[0]['generated_text']
     
-    def _generate_text(self, prompt: str) -> str:
+    def _cache_get(self, prompt: str) -> Optional[str]:
+        """Return a previously generated response for this prompt"""
+        with self._cache_lock:
+            response = self._response_cache.get(prompt)
+            if response is not None:
+                self._response_cache.move_to_end(prompt)
+            return response
+    
+    def _cache_put(self, prompt: str, response: str):
+        """Remember a generated response, evicting the least recently used"""
+        with self._cache_lock:
+            self._response_cache[prompt] = response
+            self._response_cache.move_to_end(prompt)
+            if len(self._response_cache) > self._cache_size:
+                self._response_cache.popitem(last=False)
+    
+    def _generate_text(self, prompt: str, max_tokens: int = 512) -> str:
         """Generate text using available model"""
+        # Prompts embed the test values and retrieved context, so identical
+        # prompts (e.g. the same report explained twice) can share a response
+        cached = self._cache_get(prompt)
+        if cached is not None:
+            return cached
+        
         try:
             if self.llm is not None:
-                return self._generate_with_phi(prompt)
+                response = self._generate_with_phi(prompt, max_tokens=max_tokens)
             else:
-                return self._generate_with_fallback(prompt)
+                response = self._generate_with_fallback(prompt)
         except Exception as e:
             print(f"Generation error: {e}")
-            return "Sorry, I encountered an error generating the explanation."
+            return GENERATION_ERROR
+        
+        self._cache_put(prompt, response)
+        return response
+    
+    def _stream_text(self, prompt: str, max_tokens: int = 512) -> Iterator[str]:
+        """Generate text using available model, yielding it in pieces (raises on failure)"""
+        cached = self._cache_get(prompt)
+        if cached is not None:
+            yield cached
+            return
+        
+        # The fallback pipeline can't stream; it yields its answer in one piece
+        if self.llm is None:
+            response = self._generate_with_fallback(prompt)
+            self._cache_put(prompt, response)
+            yield response
+            return
+        
+        pieces = []
+        with closing(self._stream_with_phi(prompt, max_tokens=max_tokens)) as stream:
+            for text in stream:
+                pieces.append(text)
+                yield text
+        
+        self._cache_put(prompt, "".join(pieces).strip())
     
     def _retrieve_context(self, query: str, k: int = 3) -> str:
         """Retrieve relevant context from vector database"""
+        return self._retrieve_contexts([query], k=k)[0]
+    
+    def _retrieve_contexts(self, queries: List[str], k: int = 3) -> List[str]:
+        """Retrieve context for several queries with one encode and one query call"""
+        if not queries:
+            return []
+        
         if self.collection is None:
-            return "No medical reference data available."
+            return ["No medical reference data available."] * len(queries)
         
         try:
-            # Create query embedding
-            query_embedding = self.embedding_model.encode(query).tolist()
+            # Create query embeddings in a single batch
+            query_embeddings = self.embedding_model.encode(
+                queries,
+                batch_size=32,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
             
             # Query the collection
             results = self.collection.query(
-                query_embeddings=[query_embedding],
+                query_embeddings=query_embeddings,
                 n_results=k
             )
             
-            # Combine documents
+            # Combine documents per query
             if results and results['documents']:
-                context = "\n\n".join(results['documents'][0])
-                return context
+                return [
+                    "\n\n".join(docs) if docs else "No relevant information found."
+                    for docs in results['documents']
+                ]
             else:
-                return "No relevant information found."
+                return ["No relevant information found."] * len(queries)
         except Exception as e:
             print(f"Retrieval error: {e}")
-            return "Error retrieving medical information."
+            return ["Error retrieving medical information."] * len(queries)
     
-    def explain_result(self, result: LabResult) -> str:
-        """Generate explanation for a single lab result"""
-        
-        # Retrieve relevant context
-        query = f"{result.test_name} {result.status} meaning causes treatment"
-        context = self._retrieve_context(query, k=3)
-        
-        # Create prompt
-        prompt = f"""You are a helpful medical assistant. Explain this lab result in simple terms.
-
-Medical Information:
-{context}
+    def _explanation_query(self, result: LabResult) -> str:
+        """Build the retrieval query for a single lab result"""
+        return f"{result.test_name} {result.status} meaning causes treatment"
+    
+    def _explanation_prompt(self, result: LabResult, context: str) -> str:
+        """Build the explanation prompt for a lab result and its retrieved context"""
+        return EXPLANATION_PREFIX + f"""{context}
 
 Lab Test: {result.test_name}
 Value: {result.value} {result.unit}
@@ -144,9 +333,18 @@ Please explain:
 4. Dietary recommendations if applicable
 
 Keep it simple and clear. Answer:"""
-
+    
+    def explain_result(self, result: LabResult) -> str:
+        """Generate explanation for a single lab result"""
+        
+        # Retrieve relevant context
+        context = self._retrieve_context(self._explanation_query(result), k=3)
+        
+        # Create prompt
+        prompt = self._explanation_prompt(result, context)
+        
         # Generate explanation
-        explanation = self._generate_text(prompt)
+        explanation = self._generate_text(prompt, max_tokens=EXPLANATION_MAX_TOKENS)
         
         return explanation
     
@@ -154,13 +352,39 @@ Keep it simple and clear. Answer:"""
         """Generate explanations for all lab results"""
         explanations = {}
         
-        for result in results:
+        # Retrieve context for every result in one batched lookup
+        contexts = self._retrieve_contexts(
+            [self._explanation_query(r) for r in results], k=3
+        )
+        
+        for result, context in zip(results, contexts):
             print(f"Explaining {result.test_name}...")
-            explanation = self.explain_result(result)
+            prompt = self._explanation_prompt(result, context)
+            explanation = self._generate_text(prompt, max_tokens=EXPLANATION_MAX_TOKENS)
             explanations[result.test_name] = explanation
         
         return explanations
     
+    def stream_explanations(self, results: List[LabResult]) -> Iterator[Tuple[int, str, bool]]:
+        """Yield (result index, text, failed) pieces of each explanation as it is generated"""
+        
+        # Retrieve context for every result in one batched lookup
+        contexts = self._retrieve_contexts(
+            [self._explanation_query(r) for r in results], k=3
+        )
+        
+        for index, (result, context) in enumerate(zip(results, contexts)):
+            print(f"Explaining {result.test_name}...")
+            prompt = self._explanation_prompt(result, context)
+            try:
+                with closing(self._stream_text(prompt, max_tokens=EXPLANATION_MAX_TOKENS)) as stream:
+                    for text in stream:
+                        yield index, text, False
+            except Exception as e:
+                # Sent as a failure so clients replace any partial text with it
+                print(f"Generation error: {e}")
+                yield index, GENERATION_ERROR, True
+    
     def answer_followup_question(self, question: str, lab_results: List[LabResult]) -> str:
         """Answer follow-up questions about lab results"""
         
@@ -113,17 +113,18 @@ async function uploadFile(file) {
         }
         
         currentResults = data.results;
+        explanations = null;
         showToast(`✓ Found ${data.count} lab results!`, 'success');
         
-        // Generate explanations
-        await generateExplanations();
-        
         // Display results
         displayResults();
         
         // Switch to results tab automatically
         showSection('results-section');
         
+        // Generate explanations; cards fill in as they stream
+        await generateExplanations();
+        
     } catch (error) {
         showToast(error.message, 'error');
         resetUploadArea();
@@ -134,15 +135,60 @@ async function generateExplanations() {
     // Optional: show a mini toast or loading indicator
     try {
         const response = await fetch('/api/explain', { method: 'POST' });
-        const data = await response.json();
-        if (!response.ok) throw new Error(data.error);
-        explanations = data.explanations;
+        if (!response.ok) {
+            const data = await response.json();
+            throw new Error(data.error);
+        }
+        
+        explanations = {};
+        let lastIndex = null;
+        
+        // Read the server-sent event stream; events end with a blank line
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            
+            events.forEach(event => {
+                if (!event.startsWith('data: ')) return;
+                const { index, test_name, text, error } = JSON.parse(event.slice(6));
+                
+                // A new result starts a fresh explanation for its test name
+                if (index !== lastIndex) {
+                    explanations[test_name] = '';
+                    lastIndex = index;
+                }
+                
+                // An error replaces any partial explanation instead of extending it
+                if (error !== undefined) {
+                    explanations[test_name] = error;
+                } else {
+                    explanations[test_name] += text;
+                }
+                updateExplanation(test_name);
+            });
+        }
     } catch (error) {
         console.warn('Auto-explanation generation failed:', error);
         // We continue anyway, results will just say "Loading..." or show basic info
     }
 }
 
+function updateExplanation(testName) {
+    document.querySelectorAll('.result-insight').forEach(el => {
+        if (currentResults[el.dataset.index].test_name === testName) {
+            el.textContent = explanations[testName];
+        }
+    });
+}
+
 function displayResults() {
     const container = document.getElementById('resultsContainer');
     
@@ -231,7 +277,7 @@ function createResultCard(result, index) {
         
         <div class="mt-4 pt-3 border-t border-slate-50">
             <p class="text-sm text-slate-600 leading-relaxed">
-                <span class="font-semibold text-primary">Insight:</span> ${escapeHtml(explanation)}
+                <span class="font-semibold text-primary">Insight:</span> <span class="result-insight" data-index="${index}">${escapeHtml(explanation)}</span>
             </p>
         </div>
     `;